@@ -54,3 +54,28 @@ import mlflow
  
 experiment_name = f"/Users/{useremail}/propensity"
 mlflow.set_experiment(experiment_name) 
+
+# COMMAND ----------
+
+# DBTITLE 1,Spark Performance Settings
+# In this step, we enable adaptive query execution so that shuffle partitions are coalesced and skewed joins are split at runtime:
+spark.conf.set('spark.sql.adaptive.enabled', 'true')
+spark.conf.set('spark.sql.adaptive.coalescePartitions.enabled', 'true')
+spark.conf.set('spark.sql.adaptive.skewJoin.enabled', 'true')
+spark.conf.set('spark.sql.adaptive.advisoryPartitionSizeInBytes', '128m')
+spark.conf.set('spark.sql.shuffle.partitions', '200')
+ 
+# NOTE spark.serializer is a static setting which cannot be changed from within a running session. To use Kryo, set
+# spark.serializer org.apache.spark.serializer.KryoSerializer in the Spark config of your cluster.
+
+# COMMAND ----------
+
+# DBTITLE 1,Delta Write Settings
+# In this step, we enable optimized writes and auto compaction so that the tables and feature store tables we write are bin-packed into fewer, larger files:
+spark.conf.set('spark.databricks.delta.optimizeWrite.enabled', 'true')
+spark.conf.set('spark.databricks.delta.autoCompact.enabled', 'true')
+spark.conf.set('spark.databricks.delta.optimizeWrite.binSize', '128')
+ 
+# in addition, we compress data files with snappy and size parquet row groups to match the optimized write bin size:
+spark.conf.set('spark.sql.parquet.compression.codec', 'snappy')
+spark.conf.set('parquet.block.size', str(128 * 1024 * 1024))
@@ -18,6 +18,7 @@
 # COMMAND ----------
 
 # DBTITLE 1,Import Required Libraries
+from pyspark.sql.types import *
 import pyspark.sql.functions as f
 
 # COMMAND ----------
@@ -58,30 +59,156 @@ spark.catalog.setCurrentDatabase(config['database'])
 
 # COMMAND ----------
 
+# DBTITLE 1,Define File Schemas
+# each file in the dataset has a fixed, known structure so we define schemas up front rather than inferring them:
+SCHEMAS = {
+  'transactions': StructType([
+    StructField('household_key', IntegerType(), True),
+    StructField('BASKET_ID', LongType(), True),
+    StructField('DAY', IntegerType(), True),
+    StructField('PRODUCT_ID', IntegerType(), True),
+    StructField('QUANTITY', IntegerType(), True),
+    StructField('SALES_VALUE', DoubleType(), True),
+    StructField('STORE_ID', IntegerType(), True),
+    StructField('RETAIL_DISC', DoubleType(), True),
+    StructField('TRANS_TIME', IntegerType(), True),
+    StructField('WEEK_NO', IntegerType(), True),
+    StructField('COUPON_DISC', DoubleType(), True),
+    StructField('COUPON_MATCH_DISC', DoubleType(), True)
+    ]),
+  'products': StructType([
+    StructField('PRODUCT_ID', IntegerType(), True),
+    StructField('MANUFACTURER', IntegerType(), True),
+    StructField('DEPARTMENT', StringType(), True),
+    StructField('BRAND', StringType(), True),
+    StructField('COMMODITY_DESC', StringType(), True),
+    StructField('SUB_COMMODITY_DESC', StringType(), True),
+    StructField('CURR_SIZE_OF_PRODUCT', StringType(), True)
+    ]),
+  'households': StructType([
+    StructField('AGE_DESC', StringType(), True),
+    StructField('MARITAL_STATUS_CODE', StringType(), True),
+    StructField('INCOME_DESC', StringType(), True),
+    StructField('HOMEOWNER_DESC', StringType(), True),
+    StructField('HH_COMP_DESC', StringType(), True),
+    StructField('HOUSEHOLD_SIZE_DESC', StringType(), True),
+    StructField('KID_CATEGORY_DESC', StringType(), True),
+    StructField('household_key', IntegerType(), True)
+    ]),
+  'coupons': StructType([
+    StructField('COUPON_UPC', LongType(), True),
+    StructField('PRODUCT_ID', IntegerType(), True),
+    StructField('CAMPAIGN', IntegerType(), True)
+    ]),
+  'campaigns': StructType([
+    StructField('DESCRIPTION', StringType(), True),
+    StructField('CAMPAIGN', IntegerType(), True),
+    StructField('START_DAY', IntegerType(), True),
+    StructField('END_DAY', IntegerType(), True)
+    ]),
+  'coupon_redemptions': StructType([
+    StructField('household_key', IntegerType(), True),
+    StructField('DAY', IntegerType(), True),
+    StructField('COUPON_UPC', LongType(), True),
+    StructField('CAMPAIGN', IntegerType(), True)
+    ]),
+  'campaigns_households': StructType([
+    StructField('DESCRIPTION', StringType(), True),
+    StructField('household_key', IntegerType(), True),
+    StructField('CAMPAIGN', IntegerType(), True)
+    ]),
+  'causal_data': StructType([
+    StructField('PRODUCT_ID', IntegerType(), True),
+    StructField('STORE_ID', IntegerType(), True),
+    StructField('WEEK_NO', IntegerType(), True),
+    StructField('display', StringType(), True),
+    StructField('mailer', StringType(), True)
+    ])
+  }
+
+# COMMAND ----------
+
+# DBTITLE 1,Define Function to Convert Files to Parquet
+def get_file_info(file_path):
+  
+  # return info for the file or None if it does not exist
+  try:
+    return dbutils.fs.ls(file_path)[0]
+  except Exception as e:
+    if 'java.io.FileNotFoundException' in str(e): # throws file not found if path does not exist
+      return None
+    raise
+ 
+ 
+def convert_to_parquet(table_name, csv_file_path, parquet_file_path):
+  
+  # skip conversion if file was successfully converted since it was last modified
+  # (spark writes the _SUCCESS marker only once all data has been committed)
+  csv_info = get_file_info(csv_file_path)
+  success_info = get_file_info(f'{parquet_file_path}/_SUCCESS')
+  if success_info is not None and success_info.modificationTime >= csv_info.modificationTime:
+    return
+  
+  # read data from input file using the known schema for the table
+  df = ( 
+    spark
+     .read
+       .schema(SCHEMAS[table_name])
+       .csv(
+         csv_file_path,
+         header=True
+         )
+    )
+  
+  # write data to parquet
+  _ = (
+    df
+     .write
+       .mode('overwrite')
+       .option('compression', 'snappy')
+       .parquet(parquet_file_path)
+     )
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC Parsing CSV is expensive. By supplying the schemas defined above, we avoid the additional pass over each file that schema inference would require. To avoid paying the parsing cost each time our tables are built, we convert each file to Parquet, skipping any file for which a complete Parquet copy was written after the file was last modified. Parquet is a columnar format that carries its own schema so that later reads require no inference:
+
+# COMMAND ----------
+
+# DBTITLE 1,Convert Files to Parquet
+convert_to_parquet('transactions', '{0}/bronze/transaction_data.csv'.format(config['dbfs_mount']), '{0}/bronze_parquet/transaction_data'.format(config['dbfs_mount']))
+convert_to_parquet('products', '{0}/bronze/product.csv'.format(config['dbfs_mount']), '{0}/bronze_parquet/product'.format(config['dbfs_mount']))
+convert_to_parquet('households', '{0}/bronze/hh_demographic.csv'.format(config['dbfs_mount']), '{0}/bronze_parquet/hh_demographic'.format(config['dbfs_mount']))
+convert_to_parquet('coupons', '{0}/bronze/coupon.csv'.format(config['dbfs_mount']), '{0}/bronze_parquet/coupon'.format(config['dbfs_mount']))
+convert_to_parquet('campaigns', '{0}/bronze/campaign_desc.csv'.format(config['dbfs_mount']), '{0}/bronze_parquet/campaign_desc'.format(config['dbfs_mount']))
+convert_to_parquet('coupon_redemptions', '{0}/bronze/coupon_redempt.csv'.format(config['dbfs_mount']), '{0}/bronze_parquet/coupon_redempt'.format(config['dbfs_mount']))
+convert_to_parquet('campaigns_households', '{0}/bronze/campaign_table.csv'.format(config['dbfs_mount']), '{0}/bronze_parquet/campaign_table'.format(config['dbfs_mount']))
+convert_to_parquet('causal_data', '{0}/bronze/causal_data.csv'.format(config['dbfs_mount']), '{0}/bronze_parquet/causal_data'.format(config['dbfs_mount']))
+
+# COMMAND ----------
+
 # DBTITLE 1,Define Function to Create Tables
-def create_table(database_name, table_name, dbfs_file_path):
+def create_table(database_name, table_name, parquet_file_path):
     
   # drop table if exists
   _ = spark.sql('DROP TABLE IF EXISTS `{0}`.`{1}`'.format(database_name, table_name))
  
-  # read data from input file
+  # read data from parquet file (schema is embedded)
   df = ( 
     spark
      .read
-       .csv(
-         dbfs_file_path,
-         header=True,
-         inferSchema=True
-         )
+       .parquet(parquet_file_path)
     )
   
   # convert day integers to actual dates
-  # for each column
-  for c in df.columns:
-    # if column is an integer day column
-    if c.lower().endswith('day'):
-      # convert it to a date value
-      df = df.withColumn(c, f.expr(f"date_add('2018-01-01', cast({c} as int)-1)"))
+  # (all integer day columns are converted in a single projection)
+  df = df.select(
+    *[
+      f.expr(f"date_add('2018-01-01', cast({c} as int)-1) as {c}") if c.lower().endswith('day') else f.col(c)
+      for c in df.columns
+      ]
+    )
   
   # write data to table
   _ = (
@@ -98,19 +225,19 @@ def create_table(database_name, table_name, dbfs_file_path):
 # MAGIC %md
 # MAGIC It's important to note the dates used in this data set are not proper dates. Instead, they are integer values ranging from 1 to 711 where 1 represents the first date in the range and 711 indicates the last. To make it easier to explore how time-oriented values would be employed in later steps, our function converts these to actual dates by making day 1 equal to January 1, 2018 and adjusting the other values relative to this. The use of this specific date is arbitrary and doesn't reflect any known dates associated with the original dataset.
 # MAGIC
-# MAGIC From there, we might convert the CSV files to accessible tables as follows:
+# MAGIC From there, we might convert the Parquet files to accessible tables as follows:
 
 # COMMAND ----------
 
 # DBTITLE 1,Create Tables
-create_table( config['database'], 'transactions', '{0}/bronze/transaction_data.csv'.format(config['dbfs_mount']))
-create_table( config['database'], 'products', '{0}/bronze/product.csv'.format(config['dbfs_mount']))
-create_table( config['database'], 'households', '{0}/bronze/hh_demographic.csv'.format(config['dbfs_mount']))
-create_table( config['database'], 'coupons', '{0}/bronze/coupon.csv'.format(config['dbfs_mount']))
-create_table( config['database'], 'campaigns', '{0}/bronze/campaign_desc.csv'.format(config['dbfs_mount']))
-create_table( config['database'], 'coupon_redemptions', '{0}/bronze/coupon_redempt.csv'.format(config['dbfs_mount']))
-create_table( config['database'], 'campaigns_households', '{0}/bronze/campaign_table.csv'.format(config['dbfs_mount']))
-create_table( config['database'], 'causal_data', '{0}/bronze/causal_data.csv'.format(config['dbfs_mount']))
+create_table( config['database'], 'transactions', '{0}/bronze_parquet/transaction_data'.format(config['dbfs_mount']))
+create_table( config['database'], 'products', '{0}/bronze_parquet/product'.format(config['dbfs_mount']))
+create_table( config['database'], 'households', '{0}/bronze_parquet/hh_demographic'.format(config['dbfs_mount']))
+create_table( config['database'], 'coupons', '{0}/bronze_parquet/coupon'.format(config['dbfs_mount']))
+create_table( config['database'], 'campaigns', '{0}/bronze_parquet/campaign_desc'.format(config['dbfs_mount']))
+create_table( config['database'], 'coupon_redemptions', '{0}/bronze_parquet/coupon_redempt'.format(config['dbfs_mount']))
+create_table( config['database'], 'campaigns_households', '{0}/bronze_parquet/campaign_table'.format(config['dbfs_mount']))
+create_table( config['database'], 'causal_data', '{0}/bronze_parquet/causal_data'.format(config['dbfs_mount']))
 
 # COMMAND ----------
 
@@ -123,7 +250,9 @@ display(
 
 # MAGIC %md
 # MAGIC # Adjust Transactional Data
-# MAGIC The transactional data will be the focal point of our analysis. It contains information about what was purchased by each household and when along with various discounts applied at the time of purchase. Some of this information is presented in a manner that is not easily consumable. As such, we will implement some simple logic to sum discounts and combine these with amounts paid to recreate list pricing and make other simply adjustments that make the transactional data a bit easier to consume:
+# MAGIC The transactional data will be the focal point of our analysis. It contains information about what was purchased by each household and when along with various discounts applied at the time of purchase. Some of this information is presented in a manner that is not easily consumable. As such, we will implement some simple logic to sum discounts and combine these with amounts paid to recreate list pricing and make other simply adjustments that make the transactional data a bit easier to consume.
+# MAGIC
+# MAGIC As our features will be calculated at both the household and household-commodity levels, we also carry each product's commodity assignment on this table so that it need not be joined each time features are derived. Transactions for products not found in the products table are excluded. We also generate an integer representation of each day, i.e. the number of days since January 1, 2018, so that window comparisons and day arithmetic can be performed on simple integers, and we pack flags indicating which discounts were applied to each line item into the bits of a single integer:
 
 # COMMAND ----------
 
@@ -132,25 +261,72 @@ display(
 # MAGIC  
 # MAGIC DROP TABLE IF EXISTS transactions_adj;
 # MAGIC  
-# MAGIC CREATE TABLE transactions_adj
+# MAGIC CREATE TABLE transactions_adj (
+# MAGIC   household_key INT,
+# MAGIC   basket_id BIGINT,
+# MAGIC   week_no INT,
+# MAGIC   day DATE,
+# MAGIC   trans_time INT,
+# MAGIC   store_id INT,
+# MAGIC   product_id INT NOT NULL,
+# MAGIC   amount_list DOUBLE,
+# MAGIC   campaign_coupon_discount DOUBLE,
+# MAGIC   manuf_coupon_discount DOUBLE,
+# MAGIC   manuf_coupon_match_discount DOUBLE,
+# MAGIC   total_coupon_discount DOUBLE,
+# MAGIC   instore_discount DOUBLE,
+# MAGIC   amount_paid DOUBLE,
+# MAGIC   units INT,
+# MAGIC   commodity_desc STRING,
+# MAGIC   day_int INT GENERATED ALWAYS AS (datediff(day, '2018-01-01')),
+# MAGIC   disc_bits INT GENERATED ALWAYS AS (
+# MAGIC     IF(instore_discount > 0, 1, 0) +
+# MAGIC     IF(campaign_coupon_discount > 0, 2, 0) +
+# MAGIC     IF(manuf_coupon_discount > 0, 4, 0) +
+# MAGIC     IF(total_coupon_discount > 0, 8, 0)
+# MAGIC     )
+# MAGIC   )
 # MAGIC USING DELTA
-# MAGIC AS
+# MAGIC TBLPROPERTIES (
+# MAGIC   delta.autoOptimize.optimizeWrite = true,
+# MAGIC   delta.autoOptimize.autoCompact = true
+# MAGIC   );
+# MAGIC  
+# MAGIC INSERT INTO transactions_adj (
+# MAGIC   household_key,
+# MAGIC   basket_id,
+# MAGIC   week_no,
+# MAGIC   day,
+# MAGIC   trans_time,
+# MAGIC   store_id,
+# MAGIC   product_id,
+# MAGIC   amount_list,
+# MAGIC   campaign_coupon_discount,
+# MAGIC   manuf_coupon_discount,
+# MAGIC   manuf_coupon_match_discount,
+# MAGIC   total_coupon_discount,
+# MAGIC   instore_discount,
+# MAGIC   amount_paid,
+# MAGIC   units,
+# MAGIC   commodity_desc
+# MAGIC   )
 # MAGIC   SELECT
-# MAGIC     household_key,
-# MAGIC     basket_id,
-# MAGIC     week_no,
-# MAGIC     day,
-# MAGIC     trans_time,
-# MAGIC     store_id,
-# MAGIC     product_id,
-# MAGIC     amount_list,
-# MAGIC     campaign_coupon_discount,
-# MAGIC     manuf_coupon_discount,
-# MAGIC     manuf_coupon_match_discount,
-# MAGIC     total_coupon_discount,
-# MAGIC     instore_discount,
-# MAGIC     amount_paid,
-# MAGIC     units
+# MAGIC     t.household_key,
+# MAGIC     t.basket_id,
+# MAGIC     t.week_no,
+# MAGIC     t.day,
+# MAGIC     t.trans_time,
+# MAGIC     t.store_id,
+# MAGIC     t.product_id,
+# MAGIC     t.amount_list,
+# MAGIC     t.campaign_coupon_discount,
+# MAGIC     t.manuf_coupon_discount,
+# MAGIC     t.manuf_coupon_match_discount,
+# MAGIC     t.total_coupon_discount,
+# MAGIC     t.instore_discount,
+# MAGIC     t.amount_paid,
+# MAGIC     t.units,
+# MAGIC     p.commodity_desc
 # MAGIC   FROM (
 # MAGIC     SELECT 
 # MAGIC       household_key,
@@ -175,7 +351,9 @@ display(
 # MAGIC       COALESCE(sales_value,0.0) as amount_paid,
 # MAGIC       quantity as units
 # MAGIC     FROM transactions
-# MAGIC     );
+# MAGIC     ) t
+# MAGIC   INNER JOIN products p
+# MAGIC     ON t.product_id=p.product_id;
 
 # COMMAND ----------
 
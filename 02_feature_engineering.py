@@ -5,7 +5,7 @@
 # MAGIC
 # MAGIC In an operationalized workflow, we would receive new data into the lakehouse on a periodic, i.e. daily or more frequent basis. As that data arrives, we might recalculate features for propensity scoring and store these for the purpose of making predictions, i.e. performing inference, about the future period. As these features age, they at some point become useful for training new models. This happens at the point that enough new data arrives that we can derive labels for the period they were built to predict.
 # MAGIC
-# MAGIC To simulate this workflow, we will calculate features for each of the last 30-days of our dataset. We will establish our workflow logic at the top of this notebook and then define a loop at the bottom to persist these data for later use. As part of this, we will be persisting our data to the Databricks Feature Store, a capability in the Databricks platform which simplifies the persistence and retrieval of features.
+# MAGIC To simulate this workflow, we will calculate features for each of the last 30-days of our dataset. We will establish our workflow logic at the top of this notebook and then derive the features for all 30 days at the bottom to persist these data for later use. As part of this, we will be persisting our data to the Databricks Feature Store, a capability in the Databricks platform which simplifies the persistence and retrieval of features.
 # MAGIC
 # MAGIC **NOTE** In this notebook, we are deriving features exclusively from our transactional sales data in order to keep things simple. The dataset provides access to customer demographic and promotional campaign data from which additional features would typically be derived.
 
@@ -17,6 +17,7 @@
 # COMMAND ----------
 
 # DBTITLE 1,Import Required Libraries
+from pyspark import StorageLevel
 from pyspark.sql.types import *
 import pyspark.sql.functions as f
 from pyspark.sql.window import Window
@@ -32,6 +33,34 @@ spark.catalog.setCurrentDatabase(config['database'])
 
 # COMMAND ----------
 
+# MAGIC %md
+# MAGIC Our features are derived repeatedly from the same transactional data. Rather than have Spark re-read the table each time features are calculated, we will read the adjusted transactions, which already carry the commodity assignment for each product, once and hold them in memory. Please note that persist is lazy so that we must trigger an action to actually populate the cache:
+
+# COMMAND ----------
+
+# DBTITLE 1,Cache Transactional Data
+transactions = (
+  spark
+    .table('transactions_adj')
+    .persist(StorageLevel.MEMORY_AND_DISK)
+  )
+_ = transactions.count() # force materialization of the cache
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC Features for every household and every household-commodity combination found in our transactions are returned, regardless of whether any activity occurs within a given window. As these combinations do not change between feature calculations, we identify them once, along with the first day on which each occurs, and hold them in memory as well:
+
+# COMMAND ----------
+
+# DBTITLE 1,Cache Household and Household-Commodity Combinations
+anchor_hh = transactions.groupBy('household_key').agg(f.min('day_int').alias('first_day_int')).persist()
+anchor_hh_cmd = transactions.groupBy('household_key', 'commodity_desc').agg(f.min('day_int').alias('first_day_int')).persist()
+_ = anchor_hh.count() # force materialization of the cache
+_ = anchor_hh_cmd.count() # force materialization of the cache
+
+# COMMAND ----------
+
 # MAGIC %md
 # MAGIC # Define Feature Generation Logic
 # MAGIC Our first step is to define a function to generate features from a dataframe of transactional data passed to it. In our function, we are deriving a generic set of features from the last 30, 60 and 90 day periods of the transactional data as well as from a 30-day period (aligned with the labels we wish to predict) from 1-year back. This is not exhaustive of what we could derive from these data but should give a since of how we might approach feature generation.
@@ -42,28 +71,161 @@ spark.catalog.setCurrentDatabase(config['database'])
 
 # COMMAND ----------
 
+# DBTITLE 1,Define Ratio Feature Expressions
+def get_ratio_exprs(window_suffix, days_in_window):
+  
+  '''
+  This function returns the SQL expressions used to derive ratio
+  features from the summary metrics calculated for a window.
+  
+  window_suffix: the suffix associated with the window
+  
+  days_in_window: the number of days in the window
+  '''
+  
+  return [
+
+    # per-day ratios
+    'baskets/days as baskets_per_day',
+    f'products/days as products_per_day{window_suffix}',
+    'line_items/days as line_items_per_day',
+    'amount_list/days as amount_list_per_day',
+    'instore_discount/days as instore_discount_per_day',
+    'campaign_coupon_discount/days as campaign_coupon_discount_per_day',
+    'manuf_coupon_discount/days as manuf_coupon_discount_per_day',
+    'total_coupon_discount/days as total_coupon_discount_per_day',
+    'amount_paid/days as amount_paid_per_day',
+    'days_with_instore_discount/days as days_with_instore_discount_per_days',
+    'days_with_campaign_coupon_discount/days as days_with_campaign_coupon_discount_per_days',
+    'days_with_manuf_coupon_discount/days as days_with_manuf_coupon_discount_per_days',
+    'days_with_total_coupon_discount/days as days_with_total_coupon_discount_per_days',
+
+    # per-day-in-set ratios
+    f'days/{days_in_window} as days_to_days_in_set',
+    f'baskets/{days_in_window} as baskets_per_days_in_set',
+    f'products/{days_in_window} as products_to_days_in_set',
+    f'line_items/{days_in_window} as line_items_per_days_in_set',
+    f'amount_list/{days_in_window} as amount_list_per_days_in_set',
+    f'instore_discount/{days_in_window} as instore_discount_per_days_in_set',
+    f'campaign_coupon_discount/{days_in_window} as campaign_coupon_discount_per_days_in_set',
+    f'manuf_coupon_discount/{days_in_window} as manuf_coupon_discount_per_days_in_set',
+    f'total_coupon_discount/{days_in_window} as total_coupon_discount_per_days_in_set',
+    f'amount_paid/{days_in_window} as amount_paid_per_days_in_set',
+    f'days_with_instore_discount/{days_in_window} as days_with_instore_discount_per_days_in_set',
+    f'days_with_campaign_coupon_discount/{days_in_window} as days_with_campaign_coupon_discount_per_days_in_set',
+    f'days_with_manuf_coupon_discount/{days_in_window} as days_with_manuf_coupon_discount_per_days_in_set',
+    f'days_with_total_coupon_discount/{days_in_window} as days_with_total_coupon_discount_per_days_in_set',
+
+    # per-basket ratios
+    'products/baskets as products_per_basket',
+    'line_items/baskets as line_items_per_basket',
+    'amount_list/baskets as amount_list_per_basket',
+    'instore_discount/baskets as instore_discount_per_basket',
+    'campaign_coupon_discount/baskets as campaign_coupon_discount_per_basket',
+    'manuf_coupon_discount/baskets as manuf_coupon_discount_per_basket',
+    'total_coupon_discount/baskets as total_coupon_discount_per_basket',
+    'amount_paid/baskets as amount_paid_per_basket',
+    'baskets_with_instore_discount/baskets as baskets_with_instore_discount_per_baskets',
+    'baskets_with_campaign_coupon_discount/baskets as baskets_with_campaign_coupon_discount_per_baskets',
+    'baskets_with_manuf_coupon_discount/baskets as baskets_with_manuf_coupon_discount_per_baskets',
+    'baskets_with_total_coupon_discount/baskets as baskets_with_total_coupon_discount_per_baskets',
+
+    # per-product ratios
+    'line_items/products as line_items_per_product',
+    'amount_list/products as amount_list_per_product',
+    'instore_discount/products as instore_discount_per_product',
+    'campaign_coupon_discount/products as campaign_coupon_discount_per_product',
+    'manuf_coupon_discount/products as manuf_coupon_discount_per_product',
+    'total_coupon_discount/products as total_coupon_discount_per_product',
+    'amount_paid/products as amount_paid_per_product',
+    'products_with_instore_discount/products as products_with_instore_discount_per_product',
+    'products_with_campaign_coupon_discount/products as products_with_campaign_coupon_discount_per_product',
+    'products_with_manuf_coupon_discount/products as products_with_manuf_coupon_discount_per_product',
+    'products_with_total_coupon_discount/products as products_with_total_coupon_discount_per_product',
+
+    # per-line_item ratios
+    'amount_list/line_items as amount_list_per_line_item',
+    'instore_discount/line_items as instore_discount_per_line_item',
+    'campaign_coupon_discount/line_items as campaign_coupon_discount_per_line_item',
+    'manuf_coupon_discount/line_items as manuf_coupon_discount_per_line_item',
+    'total_coupon_discount/line_items as total_coupon_discount_per_line_item',
+    'amount_paid/line_items as amount_paid_per_line_item',
+    'products_with_instore_discount/line_items as products_with_instore_discount_per_line_item',
+    'products_with_campaign_coupon_discount/line_items as products_with_campaign_coupon_discount_per_line_item',
+    'products_with_manuf_coupon_discount/line_items as products_with_manuf_coupon_discount_per_line_item',
+    'products_with_total_coupon_discount/line_items as products_with_total_coupon_discount_per_line_item',
+
+    # amount_list ratios
+    'campaign_coupon_discount/amount_list as campaign_coupon_discount_to_amount_list',
+    'manuf_coupon_discount/amount_list as manuf_coupon_discount_to_amount_list',
+    'total_coupon_discount/amount_list as total_coupon_discount_to_amount_list',
+    'amount_paid/amount_list as amount_paid_to_amount_list'
+    ]
+
+# windows as start and end offsets (in days, inclusive) back from each feature day
+WINDOWS = {
+  '30d': (30-1, 0),
+  '60d': (60-1, 0),
+  '90d': (90-1, 0),
+  '1yr': (365-1, 365-30) # the 30 day period starting 1-year back
+  }
+
+# the ratio expressions differ only by window so we generate them once for each
+RATIO_EXPRS = {
+  window: get_ratio_exprs('_'+window, start_offset - end_offset + 1)
+  for window, (start_offset, end_offset) in WINDOWS.items()
+  }
+
+# COMMAND ----------
+
 # DBTITLE 1,Define Function to Derive Features
-def get_features(df, include_commodity=False, window=None):
+# bit associated with each discount in the disc_bits field on transactions_adj
+DISCOUNT_BITS = {
+  'instore_discount': 1,
+  'campaign_coupon_discount': 2,
+  'manuf_coupon_discount': 4,
+  'total_coupon_discount': 8
+  }
+ 
+def if_discount(discount_field, value):
+  '''
+  Returns value where the discount field indicates a discount
+  was applied, otherwise null.
+  '''
+  if isinstance(value, str): value = f.col(value)
+  return f.when(f.col('disc_bits').bitwiseAND(DISCOUNT_BITS[discount_field]) != 0, value)
+ 
+ 
+def get_features(df, days, anchor_df, include_commodity=False, window=None):
   
   '''
   This function derives a number of features from our transactional data.
   These data are grouped by either just the household_key or the household_key
   and commodity_desc field and are filtered based on a window prescribed
-  with the function call.
+  with the function call. Features are derived for each of the days
+  provided in a single pass over the transactional data.
   
   df: the dataframe containing household transaction history
   
+  days: a dataframe with a single day column identifying the days
+        for which features should be derived
+  
+  anchor_df: the dataframe containing the distinct grouping items
+             (household_key or household_key and commodity_desc)
+             for which features should be returned along with the
+             first day_int on which each occurs (first_day_int)
+  
   include_commodity: controls whether data grouped on:
      household_key (include_commodity=False) or 
      household_key and commodity_desc (include_commodity=True)
   
   window: one of four supported string values:
-    '30d': derive metrics from the last 30 days of the dataset
-    '60d': derive metrics from the last 60 days of the dataset
-    '90d': derive metrics from the last 90 days of the dataset
+    '30d': derive metrics from the 30 days ending on each day
+    '60d': derive metrics from the 60 days ending on each day
+    '90d': derive metrics from the 90 days ending on each day
     '1yr': derive metrics from the 30 day period starting 1-year
-           prior to the end of the dataset. this aligns with the
-           period from which our labels are derived.
+           prior to each day. this aligns with the period from
+           which our labels are derived.
   '''
   
   # determine how to group transaction data for metrics calculations
@@ -73,204 +235,154 @@ def get_features(df, include_commodity=False, window=None):
     grouping_fields += ['commodity_desc']
     grouping_suffix = '_cmd'
     
-  # get list of distinct grouping items in the original dataframe
-  anchor_df = transactions.select(grouping_fields).distinct()
-  
-  # identify when dataset starts and ends
-  min_day, max_day = (
-    df
-      .groupBy()
-        .agg(
-          f.min('day').alias('min_day'), 
-          f.max('day').alias('max_day')
-          )
-      .collect()
-    )[0]    
-  
-  ## print info to support validation
-  #print('{0}:\t{1} days in original set between {2} and {3}'.format(window, (max_day - min_day).days + 1, min_day, max_day))
+  # associate distinct grouping items with each day
+  # (days are also expressed as integer offsets from 2018-01-01, consistent with day_int on transactions_adj)
+  day_fields = ['feature_day', 'feature_day_int']
+  feature_days = days.select(
+    f.col('day').alias('feature_day'),
+    f.datediff('day', f.lit('2018-01-01')).alias('feature_day_int')
+    )
+  anchor_df = anchor_df.crossJoin(feature_days)
   
-  # adjust min and max days based on specified window   
-  if window == '30d':
-    window_suffix = '_'+window
-    min_day = max_day - timedelta(days=30-1)
-    
-  elif window == '60d':
-    window_suffix = '_'+window
-    min_day = max_day - timedelta(days=60-1)
-    
-  elif window == '90d':
-    window_suffix = '_'+window
-    min_day = max_day - timedelta(days=90-1)
-    
-  elif window == '1yr':
-    window_suffix = '_'+window
-    min_day = max_day - timedelta(days=365-1)
-    max_day = min_day + timedelta(days=30-1)
-    
-  else:
+  # determine the start and end of the window as offsets (in days) back from each day
+  if window not in WINDOWS:
     raise Exception('unknown window definition')
-  
-  # determine the number of days in the window
-  days_in_window = (max_day - min_day).days + 1
-  
-  ## print to help with date math validation
-  #print('{0}:\t{1} days in adjusted set between {2} and {3}'.format(window, days_in_window, min_day, max_day))
-  
-  # convert dates to strings to make remaining steps easier
-  max_day = max_day.strftime('%Y-%m-%d')
-  min_day = min_day.strftime('%Y-%m-%d')
+  window_suffix = '_'+window
+  start_offset, end_offset = WINDOWS[window]
   
   # derive summary features from set
+  # (all metrics are cast as doubles to avoid confusion as categoricals)
   summary_df = (
     df
-      .filter(f.expr(f"day between '{min_day}' and '{max_day}'")) # constrain to window
-      .groupBy(grouping_fields)
+      .join( # associate each transaction with each day whose window it falls within
+        f.broadcast(feature_days),
+        on=f.col('day_int').between(f.col('feature_day_int') - start_offset, f.col('feature_day_int') - end_offset),
+        how='inner'
+        )
+      .groupBy(day_fields + grouping_fields)
         .agg(
           
           # summary metrics
-          f.countDistinct('day').alias('days'), 
-          f.countDistinct('basket_id').alias('baskets'),
-          f.count('product_id').alias('products'), 
-          f.count('*').alias('line_items'),
-          f.sum('amount_list').alias('amount_list'),
-          f.sum('instore_discount').alias('instore_discount'),
-          f.sum('campaign_coupon_discount').alias('campaign_coupon_discount'),
-          f.sum('manuf_coupon_discount').alias('manuf_coupon_discount'),
-          f.sum('total_coupon_discount').alias('total_coupon_discount'),
-          f.sum('amount_paid').alias('amount_paid'),
+          f.countDistinct('day_int').cast(DoubleType()).alias('days'), 
+          f.countDistinct('basket_id').cast(DoubleType()).alias('baskets'),
+          f.count('*').cast(DoubleType()).alias('products'), # product_id is NOT NULL on transactions_adj so products and line_items
+          f.count('*').cast(DoubleType()).alias('line_items'), # are the same count, calculated once by the aggregation
+          f.sum('amount_list').cast(DoubleType()).alias('amount_list'),
+          f.sum('instore_discount').cast(DoubleType()).alias('instore_discount'),
+          f.sum('campaign_coupon_discount').cast(DoubleType()).alias('campaign_coupon_discount'),
+          f.sum('manuf_coupon_discount').cast(DoubleType()).alias('manuf_coupon_discount'),
+          f.sum('total_coupon_discount').cast(DoubleType()).alias('total_coupon_discount'),
+          f.sum('amount_paid').cast(DoubleType()).alias('amount_paid'),
           
           # unique days with activity
-          f.countDistinct(f.expr('case when instore_discount >0 then day else null end')).alias('days_with_instore_discount'),
-          f.countDistinct(f.expr('case when campaign_coupon_discount >0 then day else null end')).alias('days_with_campaign_coupon_discount'),
-          f.countDistinct(f.expr('case when manuf_coupon_discount >0 then day else null end')).alias('days_with_manuf_coupon_discount'),
-          f.countDistinct(f.expr('case when total_coupon_discount >0 then day else null end')).alias('days_with_total_coupon_discount'),
+          f.countDistinct(if_discount('instore_discount', 'day_int')).cast(DoubleType()).alias('days_with_instore_discount'),
+          f.countDistinct(if_discount('campaign_coupon_discount', 'day_int')).cast(DoubleType()).alias('days_with_campaign_coupon_discount'),
+          f.countDistinct(if_discount('manuf_coupon_discount', 'day_int')).cast(DoubleType()).alias('days_with_manuf_coupon_discount'),
+          f.countDistinct(if_discount('total_coupon_discount', 'day_int')).cast(DoubleType()).alias('days_with_total_coupon_discount'),
           
           # unique baskets with activity
-          f.countDistinct(f.expr('case when instore_discount >0 then basket_id else null end')).alias('baskets_with_instore_discount'),
-          f.countDistinct(f.expr('case when campaign_coupon_discount >0 then basket_id else null end')).alias('baskets_with_campaign_coupon_discount'),
-          f.countDistinct(f.expr('case when manuf_coupon_discount >0 then basket_id else null end')).alias('baskets_with_manuf_coupon_discount'),
-          f.countDistinct(f.expr('case when total_coupon_discount >0 then basket_id else null end')).alias('baskets_with_total_coupon_discount'),          
+          f.countDistinct(if_discount('instore_discount', 'basket_id')).cast(DoubleType()).alias('baskets_with_instore_discount'),
+          f.countDistinct(if_discount('campaign_coupon_discount', 'basket_id')).cast(DoubleType()).alias('baskets_with_campaign_coupon_discount'),
+          f.countDistinct(if_discount('manuf_coupon_discount', 'basket_id')).cast(DoubleType()).alias('baskets_with_manuf_coupon_discount'),
+          f.countDistinct(if_discount('total_coupon_discount', 'basket_id')).cast(DoubleType()).alias('baskets_with_total_coupon_discount'),          
     
           # unique products with activity
-          f.countDistinct(f.expr('case when instore_discount >0 then product_id else null end')).alias('products_with_instore_discount'),
-          f.countDistinct(f.expr('case when campaign_coupon_discount >0 then product_id else null end')).alias('products_with_campaign_coupon_discount'),
-          f.countDistinct(f.expr('case when manuf_coupon_discount >0 then product_id else null end')).alias('products_with_manuf_coupon_discount'),
-          f.countDistinct(f.expr('case when total_coupon_discount >0 then product_id else null end')).alias('products_with_total_coupon_discount'),          
+          f.countDistinct(if_discount('instore_discount', 'product_id')).cast(DoubleType()).alias('products_with_instore_discount'),
+          f.countDistinct(if_discount('campaign_coupon_discount', 'product_id')).cast(DoubleType()).alias('products_with_campaign_coupon_discount'),
+          f.countDistinct(if_discount('manuf_coupon_discount', 'product_id')).cast(DoubleType()).alias('products_with_manuf_coupon_discount'),
+          f.countDistinct(if_discount('total_coupon_discount', 'product_id')).cast(DoubleType()).alias('products_with_total_coupon_discount'),          
     
           # unique line items with activity
-          f.sum(f.expr('case when instore_discount >0 then 1 else null end')).alias('line_items_with_instore_discount'),
-          f.sum(f.expr('case when campaign_coupon_discount >0 then 1 else null end')).alias('line_items_with_campaign_coupon_discount'),
-          f.sum(f.expr('case when manuf_coupon_discount >0 then 1 else null end')).alias('line_items_with_manuf_coupon_discount'),
-          f.sum(f.expr('case when total_coupon_discount >0 then 1 else null end')).alias('line_items_with_total_coupon_discount')          
+          f.sum(if_discount('instore_discount', 1)).cast(DoubleType()).alias('line_items_with_instore_discount'),
+          f.sum(if_discount('campaign_coupon_discount', 1)).cast(DoubleType()).alias('line_items_with_campaign_coupon_discount'),
+          f.sum(if_discount('manuf_coupon_discount', 1)).cast(DoubleType()).alias('line_items_with_manuf_coupon_discount'),
+          f.sum(if_discount('total_coupon_discount', 1)).cast(DoubleType()).alias('line_items_with_total_coupon_discount'),
+          
+          # days since activity
+          f.min(f.col('feature_day_int') - end_offset - if_discount('instore_discount', 'day_int').otherwise(f.col('feature_day_int') - start_offset)).cast(DoubleType()).alias('days_since_instore_discount'),
+          f.min(f.col('feature_day_int') - end_offset - if_discount('campaign_coupon_discount', 'day_int').otherwise(f.col('feature_day_int') - start_offset)).cast(DoubleType()).alias('days_since_campaign_coupon_discount'),
+          f.min(f.col('feature_day_int') - end_offset - if_discount('manuf_coupon_discount', 'day_int').otherwise(f.col('feature_day_int') - start_offset)).cast(DoubleType()).alias('days_since_manuf_coupon_discount'),
+          f.min(f.col('feature_day_int') - end_offset - if_discount('total_coupon_discount', 'day_int').otherwise(f.col('feature_day_int') - start_offset)).cast(DoubleType()).alias('days_since_total_coupon_discount')
           )    
     
-      # per-day ratios
-      .withColumn(f'baskets_per_day', f.expr('baskets/days'))
-      .withColumn(f'products_per_day{window_suffix}', f.expr('products/days'))
-      .withColumn(f'line_items_per_day', f.expr('line_items/days'))
-      .withColumn(f'amount_list_per_day', f.expr('amount_list/days'))
-      .withColumn(f'instore_discount_per_day', f.expr('instore_discount/days'))
-      .withColumn(f'campaign_coupon_discount_per_day', f.expr('campaign_coupon_discount/days'))
-      .withColumn(f'manuf_coupon_discount_per_day', f.expr('manuf_coupon_discount/days'))
-      .withColumn(f'total_coupon_discount_per_day', f.expr('total_coupon_discount/days'))
-      .withColumn(f'amount_paid_per_day', f.expr('amount_paid/days'))
-      .withColumn(f'days_with_instore_discount_per_days', f.expr('days_with_instore_discount/days'))
-      .withColumn(f'days_with_campaign_coupon_discount_per_days', f.expr('days_with_campaign_coupon_discount/days'))
-      .withColumn(f'days_with_manuf_coupon_discount_per_days', f.expr('days_with_manuf_coupon_discount/days'))
-      .withColumn(f'days_with_total_coupon_discount_per_days', f.expr('days_with_total_coupon_discount/days'))
-    
-      # per-day-in-set ratios
-      .withColumn(f'days_to_days_in_set', f.expr(f'days/{days_in_window}'))
-      .withColumn(f'baskets_per_days_in_set', f.expr(f'baskets/{days_in_window}'))
-      .withColumn(f'products_to_days_in_set', f.expr(f'products/{days_in_window}'))
-      .withColumn(f'line_items_per_days_in_set', f.expr(f'line_items/{days_in_window}'))
-      .withColumn(f'amount_list_per_days_in_set', f.expr(f'amount_list/{days_in_window}'))
-      .withColumn(f'instore_discount_per_days_in_set', f.expr(f'instore_discount/{days_in_window}'))
-      .withColumn(f'campaign_coupon_discount_per_days_in_set', f.expr(f'campaign_coupon_discount/{days_in_window}'))
-      .withColumn(f'manuf_coupon_discount_per_days_in_set', f.expr(f'manuf_coupon_discount/{days_in_window}'))
-      .withColumn(f'total_coupon_discount_per_days_in_set', f.expr(f'total_coupon_discount/{days_in_window}'))
-      .withColumn(f'amount_paid_per_days_in_set', f.expr(f'amount_paid/{days_in_window}'))
-      .withColumn(f'days_with_instore_discount_per_days_in_set', f.expr(f'days_with_instore_discount/{days_in_window}'))
-      .withColumn(f'days_with_campaign_coupon_discount_per_days_in_set', f.expr(f'days_with_campaign_coupon_discount/{days_in_window}'))
-      .withColumn(f'days_with_manuf_coupon_discount_per_days_in_set', f.expr(f'days_with_manuf_coupon_discount/{days_in_window}'))
-      .withColumn(f'days_with_total_coupon_discount_per_days_in_set', f.expr(f'days_with_total_coupon_discount/{days_in_window}'))
- 
-      # per-basket ratios
-      .withColumn('products_per_basket', f.expr('products/baskets'))
-      .withColumn('line_items_per_basket', f.expr('line_items/baskets'))
-      .withColumn('amount_list_per_basket', f.expr('amount_list/baskets'))      
-      .withColumn('instore_discount_per_basket', f.expr('instore_discount/baskets'))  
-      .withColumn('campaign_coupon_discount_per_basket', f.expr('campaign_coupon_discount/baskets')) 
-      .withColumn('manuf_coupon_discount_per_basket', f.expr('manuf_coupon_discount/baskets'))
-      .withColumn('total_coupon_discount_per_basket', f.expr('total_coupon_discount/baskets'))    
-      .withColumn('amount_paid_per_basket', f.expr('amount_paid/baskets'))
-      .withColumn('baskets_with_instore_discount_per_baskets', f.expr('baskets_with_instore_discount/baskets'))
-      .withColumn('baskets_with_campaign_coupon_discount_per_baskets', f.expr('baskets_with_campaign_coupon_discount/baskets'))
-      .withColumn('baskets_with_manuf_coupon_discount_per_baskets', f.expr('baskets_with_manuf_coupon_discount/baskets'))
-      .withColumn('baskets_with_total_coupon_discount_per_baskets', f.expr('baskets_with_total_coupon_discount/baskets'))
-      
-      # per-product ratios
-      .withColumn('line_items_per_product', f.expr('line_items/products'))
-      .withColumn('amount_list_per_product', f.expr('amount_list/products'))      
-      .withColumn('instore_discount_per_product', f.expr('instore_discount/products'))  
-      .withColumn('campaign_coupon_discount_per_product', f.expr('campaign_coupon_discount/products')) 
-      .withColumn('manuf_coupon_discount_per_product', f.expr('manuf_coupon_discount/products'))
-      .withColumn('total_coupon_discount_per_product', f.expr('total_coupon_discount/products'))    
-      .withColumn('amount_paid_per_product', f.expr('amount_paid/products'))
-      .withColumn('products_with_instore_discount_per_product', f.expr('products_with_instore_discount/products'))
-      .withColumn('products_with_campaign_coupon_discount_per_product', f.expr('products_with_campaign_coupon_discount/products'))
-      .withColumn('products_with_manuf_coupon_discount_per_product', f.expr('products_with_manuf_coupon_discount/products'))
-      .withColumn('products_with_total_coupon_discount_per_product', f.expr('products_with_total_coupon_discount/products'))
-      
-      # per-line_item ratios
-      .withColumn('amount_list_per_line_item', f.expr('amount_list/line_items'))      
-      .withColumn('instore_discount_per_line_item', f.expr('instore_discount/line_items'))  
-      .withColumn('campaign_coupon_discount_per_line_item', f.expr('campaign_coupon_discount/line_items')) 
-      .withColumn('manuf_coupon_discount_per_line_item', f.expr('manuf_coupon_discount/line_items'))
-      .withColumn('total_coupon_discount_per_line_item', f.expr('total_coupon_discount/line_items'))    
-      .withColumn('amount_paid_per_line_item', f.expr('amount_paid/line_items'))
-      .withColumn('products_with_instore_discount_per_line_item', f.expr('products_with_instore_discount/line_items'))
-      .withColumn('products_with_campaign_coupon_discount_per_line_item', f.expr('products_with_campaign_coupon_discount/line_items'))
-      .withColumn('products_with_manuf_coupon_discount_per_line_item', f.expr('products_with_manuf_coupon_discount/line_items'))
-      .withColumn('products_with_total_coupon_discount_per_line_item', f.expr('products_with_total_coupon_discount/line_items'))    
-    
-      # amount_list ratios
-      .withColumn('campaign_coupon_discount_to_amount_list', f.expr('campaign_coupon_discount/amount_list'))
-      .withColumn('manuf_coupon_discount_to_amount_list', f.expr('manuf_coupon_discount/amount_list'))
-      .withColumn('total_coupon_discount_to_amount_list', f.expr('total_coupon_discount/amount_list'))
-      .withColumn('amount_paid_to_amount_list', f.expr('amount_paid/amount_list'))
-      )
- 
- 
-  # derive days-since metrics
-  dayssince_df = (
-    df
-      .filter(f.expr(f"day <= '{max_day}'"))
-      .groupBy(grouping_fields)
-        .agg(
-          f.min(f.expr(f"'{max_day}' - case when instore_discount >0 then day else '{min_day}' end")).alias('days_since_instore_discount'),
-          f.min(f.expr(f"'{max_day}' - case when campaign_coupon_discount >0 then day else '{min_day}' end")).alias('days_since_campaign_coupon_discount'),
-          f.min(f.expr(f"'{max_day}' - case when manuf_coupon_discount >0 then day else '{min_day}' end")).alias('days_since_manuf_coupon_discount'),
-          f.min(f.expr(f"'{max_day}' - case when total_coupon_discount >0 then day else '{min_day}' end")).alias('days_since_total_coupon_discount')
-          )
+      # derive ratios in a single projection
+      .selectExpr('*', *RATIO_EXPRS[window])
       )
   
-  # combine metrics with anchor set to form return set 
-  ret_df = (
-    anchor_df
-      .join(summary_df, on=grouping_fields, how='leftouter')
-      .join(dayssince_df, on=grouping_fields, how='leftouter')
-    )
+  # combine metrics with anchor set to form return set
+  ret_df = anchor_df.join(summary_df, on=day_fields + grouping_fields, how='leftouter')
+  
+  # assign the maximum days-since value for the window to groups with history up to the
+  # end of the window but no activity within it
+  has_history = f.col('first_day_int') <= f.col('feature_day_int') - end_offset
+  for c in DISCOUNT_BITS:
+    ret_df = ret_df.withColumn(
+      f'days_since_{c}',
+      f.when(has_history, f.coalesce(f.col(f'days_since_{c}'), f.lit(float(start_offset - end_offset))))
+      )
+  ret_df = ret_df.drop('feature_day_int', 'first_day_int')
   
   # rename fields based on control parameters
-  for c in ret_df.columns:
-    if c not in grouping_fields: # don't rename grouping fields
-      ret_df = ret_df.withColumn(c, f.col(c).cast(DoubleType())) # cast all metrics as doubles to avoid confusion as categoricals
-      ret_df = ret_df.withColumnRenamed(c,f'{c}{grouping_suffix}{window_suffix}')
+  ret_df = ret_df.toDF(
+    'day',
+    *grouping_fields, # don't rename grouping fields
+    *[f'{c}{grouping_suffix}{window_suffix}' for c in ret_df.columns if c not in ['feature_day'] + grouping_fields]
+    )
  
   return ret_df
 
 # COMMAND ----------
 
+# MAGIC %md
+# MAGIC # Generate Features
+# MAGIC With our feature generation logic defined, we can now simulate our daily workflow by calculating features for each of the last 30 days in our dataset. Rather than recalculating features once for each day, each call to our function derives the features for all 30 days in a single pass, after which we combine household and household-commodity features for each of our windows and persist the results to the Feature Store:
+
+# COMMAND ----------
+
+# DBTITLE 1,Generate Features for Last 30 Days
+fs = FeatureStoreClient()
+
+# identify last day in dataset
+# (as transactions_adj is cached, this aggregates the in-memory copy and returns a single value to the driver)
+last_day = spark.sql('SELECT max(day) as last_day FROM transactions_adj').first()['last_day']
+
+# identify each of the last 30 days
+feature_days = spark.createDataFrame(
+  [(last_day - timedelta(days=d),) for d in range(30-1, -1, -1)],
+  schema='day date'
+  )
+
+# derive household features
+household_features = (
+  get_features(transactions, feature_days, anchor_hh, False, '30d')
+    .join(get_features(transactions, feature_days, anchor_hh, False, '60d'), on=['day','household_key'])
+    .join(get_features(transactions, feature_days, anchor_hh, False, '90d'), on=['day','household_key'])
+    .join(get_features(transactions, feature_days, anchor_hh, False, '1yr'), on=['day','household_key'])
+  )
+
+# derive household-commodity features
+commodity_features = (
+  get_features(transactions, feature_days, anchor_hh_cmd, True, '30d')
+    .join(get_features(transactions, feature_days, anchor_hh_cmd, True, '60d'), on=['day','household_key','commodity_desc'])
+    .join(get_features(transactions, feature_days, anchor_hh_cmd, True, '90d'), on=['day','household_key','commodity_desc'])
+    .join(get_features(transactions, feature_days, anchor_hh_cmd, True, '1yr'), on=['day','household_key','commodity_desc'])
+  )
+
+# combine features
+features = (
+  household_features
+    .join(commodity_features, on=['day','household_key'])
+  )
+
+# write features to feature store
+_ = fs.create_table(
+  name=f"{config['database']}.propensity_features",
+  primary_keys=['household_key','commodity_desc','day'],
+  df=features,
+  description='household and household-commodity features for propensity scoring'
+  )
 
+# release cached data
+_ = anchor_hh_cmd.unpersist()
+_ = anchor_hh.unpersist()
+_ = transactions.unpersist()